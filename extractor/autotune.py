@@ -0,0 +1,130 @@
+# %% Re-derive the parameters table (init_p, N, rho, alpha for every size group) from a sample of papers
+import itertools
+import json
+import math
+import os
+import time
+from itertools import islice
+
+import fire
+import numpy as np
+
+from extractor_utils import (CEmethod, SampleSize, get_count_matrix, get_scores, keywords_filtering, read_keywords,
+                             read_parameters)
+from paper_store import iter_paper_texts
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The first groups have at most 30 sentences, which are all extracted without CE
+FIRST_CE_GROUP = 3
+LAST_GROUP = 25
+
+
+def get_group_samples(sent_lists, group, num_samples, seed=666):
+    """ num_samples windows of 10 * group + 5 consecutive filtered sentences (the middle of the group),
+        taken from the concatenation of the sample papers in a random order """
+    rng = np.random.default_rng(seed + group)
+    size = 10 * group + 5
+    samples = []
+    for _ in range(num_samples):
+        order = rng.permutation(len(sent_lists))
+        sents = [sent for idx in order for sent in sent_lists[idx]]
+        start = rng.integers(0, len(sents) - size + 1)
+        samples.append(sents[start: start + size])
+    return samples
+
+
+def acceptance(size, init_p, max_selected=30):
+    """ probability that a first CE sample selects at most max_selected of size sentences """
+    return sum(math.comb(size, k) * init_p ** k * (1 - init_p) ** (size - k) for k in range(max_selected + 1))
+
+
+def run(sents, init_p, N, rho, alpha, seed):
+    """ wall time, samples scored and entropy of the extracted sentences of one CE run """
+    rng = np.random.default_rng(seed)
+    sample_size = SampleSize(N)
+    start = time.perf_counter()
+    p = CEmethod(sents, N=N, init_p=init_p, rho=rho, alpha=alpha, rng=rng, sample_size=sample_size)
+    wall_time = time.perf_counter() - start
+    selection = rng.binomial(1, p=p)
+    entropy = get_scores(selection[None], get_count_matrix(sents))[0]
+    return wall_time, sample_size.spent, entropy
+
+
+def pareto_front(results):
+    """ the results no other result beats on both wall time and entropy, fastest first """
+    front = []
+    for result in sorted(results, key=lambda r: (r['time'], -r['entropy'])):
+        if len(front) == 0 or result['entropy'] > front[-1]['entropy']:
+            front.append(result)
+    return front
+
+
+def main(source, output_file, time_budget=1.0, num_papers=50, num_samples=3,
+         init_p=(0.2, 0.3, 0.4, 0.5), N=(1000, 10000), rho=(0.05, 0.1), alpha=(0.7, 0.9),
+         groups=None, keywords_file=os.path.join(HERE, 'keywords.txt'),
+         parameters_file=os.path.join(HERE, 'parameters.txt'), results_file=None):
+    """
+    Sweep init_p, N, rho and alpha for every size group and write a new parameters file.
+    For every group, the chosen setting is the one with the highest mean entropy among the settings
+    on the Pareto front (wall time vs entropy) whose mean wall time is within time_budget seconds.
+    :param source: the sample papers, a directory of paper jsons, a manifest file or a store file
+    :param output_file: the new parameters file
+    :param time_budget: the wall time budget of one CE run in seconds
+    :param num_papers: the number of sample papers read from source
+    :param num_samples: the number of sentence lists per group
+    :param groups: the groups to tune (all CE groups by default), the others keep their setting in parameters_file
+    :param results_file: optional jsonl file for every measurement
+    """
+    keywords = read_keywords(keywords_file)
+    sent_lists = []
+    for _, text in islice(iter_paper_texts(source), num_papers):
+        _, cleaned_filtered_sents = keywords_filtering(text, keywords)
+        sent_lists.append(cleaned_filtered_sents)
+    assert sum(len(sents) for sents in sent_lists) >= 10 * LAST_GROUP + 5, 'not enough sentences in the papers'
+
+    groups = range(FIRST_CE_GROUP, LAST_GROUP + 1) if groups is None else groups
+    # fire gives a single group as an int
+    groups = [groups] if isinstance(groups, int) else groups
+    grid = list(itertools.product(init_p, N, rho, alpha))
+    chosen = {}
+    all_results = []
+    for group in groups:
+        samples = get_group_samples(sent_lists, group, num_samples)
+        results = []
+        for setting in grid:
+            # CEmethod draws again until some sample of a batch is valid,
+            # skip the settings where a first batch of N samples would hardly ever have one
+            if setting[1] * acceptance(10 * group + 5, setting[0]) < 1:
+                continue
+            runs = [run(sents, *setting, seed) for seed, sents in enumerate(samples)]
+            wall_time, spent, entropy = np.mean(runs, axis=0)
+            results.append({'group': group, 'init_p': setting[0], 'N': setting[1], 'rho': setting[2],
+                            'alpha': setting[3], 'time': float(wall_time), 'samples': float(spent),
+                            'entropy': float(entropy)})
+        all_results += results
+        front = pareto_front(results)
+        if len(front) == 0:
+            print(f'group {group}: no usable setting, keeping the setting of {parameters_file}')
+            continue
+        within_budget = [result for result in front if result['time'] <= time_budget]
+        chosen[group] = within_budget[-1] if len(within_budget) > 0 else front[0]
+        print(f'group {group}: ' + ', '.join(f'({r["init_p"]} {r["N"]} {r["rho"]} {r["alpha"]}: '
+                                             f'{r["time"]:.3f}s {r["entropy"]:.3f})' for r in front))
+
+    parameters = read_parameters(parameters_file)
+    for group, setting in chosen.items():
+        parameters[group] = (setting['init_p'], setting['N'], setting['rho'], setting['alpha'])
+    with open(output_file, 'w', encoding='utf8') as f:
+        for group, (init_p, init_n, rho, alpha) in enumerate(parameters):
+            f.write(f'{group} {init_p} {init_n} {rho} {alpha}\n')
+
+    if results_file is not None:
+        with open(results_file, 'w', encoding='utf8') as f:
+            for result in all_results:
+                f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    # python autotune.py dataset/paper_jsons parameters_tuned.txt --time_budget 0.5
+    fire.Fire(main)
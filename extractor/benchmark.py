@@ -0,0 +1,144 @@
+# %% Benchmarks for the extractor
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import fire
+import numpy as np
+
+from extractor import Extractor
+from extractor_utils import (CEmethod, SampleSize, get_count_matrix, get_full_text, get_scores, get_sents,
+                             keywords_filtering, preload)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Made up words for the synthetic papers (none of them an abbreviation like al. that joins sentences),
+# every sentence has one keyword
+SYLLABLES = ['ta', 'ko', 'ri', 'mens', 'ar', 'tor', 'vi', 'ex', 'pla', 'nu', 'sed', 'qua', 'li', 'ber', 'on']
+KEYWORDS = ['propose', 'results', 'outperforms', 'evaluate', 'dataset', 'improves', 'show', 'baseline']
+
+COLD_START = {
+    'import': 'import extractor_utils',
+    'import + first use': 'import extractor_utils; extractor_utils.clean_text("We propose a first sentence.")',
+}
+
+
+def time_in_fresh_process(code: str) -> float:
+    """ wall time of running code in a new python process, so nothing is cached in memory """
+    timer = 'import time; _start = time.perf_counter(); {}; print(time.perf_counter() - _start)'.format(code)
+    out = subprocess.run([sys.executable, '-c', timer], cwd=HERE, check=True, stdout=subprocess.PIPE,
+                         universal_newlines=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def import_time(repeat=5):
+    """ Cold-start cost of the extractor: importing extractor_utils, and importing it plus cleaning
+        a first sentence (which loads the nltk resources). Run it on two revisions to compare. """
+    for name, code in COLD_START.items():
+        times = [time_in_fresh_process(code) for _ in range(repeat)]
+        print(f'{name:<20} median {np.median(times):.3f}s  min {np.min(times):.3f}s  ({repeat} runs)')
+
+
+def synthetic_paper(group, seed=666, sent_len=25, vocab_size=3000) -> str:
+    """ a paper with 10 * group + 5 keyword sentences (the middle of the group, at most the 250 sentences
+        get_sents keeps) of zipf distributed words """
+    rng = np.random.default_rng(seed + group)
+    vocab = [''.join(rng.choice(SYLLABLES, size=rng.integers(1, 4))) + 's' * int(rng.integers(0, 2))
+             for _ in range(vocab_size)]
+    sents = []
+    for _ in range(min(10 * group + 5, 250)):
+        ranks = np.minimum(rng.zipf(1.3, size=sent_len), vocab_size) - 1
+        words = [vocab[rank] for rank in ranks]
+        # Not the first word, capitalized it would not match the keyword
+        words[rng.integers(1, sent_len)] = rng.choice(KEYWORDS)
+        sents.append(' '.join(words).capitalize() + '.')
+    return ' '.join(sents)
+
+
+def measure(fn, *args, repeat=1):
+    """ result, best wall time over repeat runs and peak traced memory (in a separate traced run) of fn(*args) """
+    wall_time = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        wall_time = min(wall_time, time.perf_counter() - start)
+    tracemalloc.start()
+    result = fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, wall_time, peak
+
+
+def bench_paper(extractor: Extractor, name, text, repeat=1, expected_group=None):
+    """ per-stage measurements of one paper, expected_group: the size group the paper must fall in """
+    records = []
+
+    def record(stage, wall_time, peak, **kwargs):
+        records.append({'paper': name, 'stage': stage, 'time': wall_time, 'peak_memory': peak, **kwargs})
+
+    _, wall_time, peak = measure(get_sents, text, repeat=repeat)
+    record('get_sents', wall_time, peak)
+    (filtered_sents, cleaned_filtered_sents), wall_time, peak = measure(keywords_filtering, text, extractor.keywords,
+                                                                        repeat=repeat)
+    record('keywords_filtering', wall_time, peak, sents=len(filtered_sents))
+
+    group = len(filtered_sents) // 10
+    assert expected_group is None or group == expected_group, \
+        f'{name} has {len(filtered_sents)} keyword sentences, not in group {expected_group}'
+    if len(filtered_sents) > 30:
+        init_p, init_n, rho, alpha = extractor.parameters[group]
+        sample_sizes = []
+
+        def run_ce():
+            sample_sizes.append(SampleSize(init_n))
+            return CEmethod(cleaned_filtered_sents, N=init_n, init_p=init_p, rho=rho, alpha=alpha,
+                            rng=np.random.default_rng(666), sample_size=sample_sizes[-1])
+
+        p, wall_time, peak = measure(run_ce, repeat=repeat)
+        selection = np.random.default_rng(666).binomial(1, p=p)
+        entropy = get_scores(selection[None], get_count_matrix(cleaned_filtered_sents))[0]
+        samples = sample_sizes[-1].spent
+        record('CEmethod', wall_time, peak, group=group, samples=samples, samples_per_second=samples / wall_time,
+               entropy=float(entropy))
+
+    _, wall_time, peak = measure(extractor.extract, text, repeat=repeat)
+    record('extract', wall_time, peak, group=group)
+    return records
+
+
+def run(paper=os.path.join(HERE, 'paper.json'), groups=range(3, 26), repeat=1, json_output=False,
+        keywords_file=os.path.join(HERE, 'keywords.txt'), parameters_file=os.path.join(HERE, 'parameters.txt')):
+    """
+    Benchmark get_sents, keywords_filtering, CEmethod and Extractor.extract on a real paper and on
+    synthetic papers of every size group: wall time (best of repeat), peak memory, CE samples per second
+    and the entropy of the extracted sentences.
+    :param paper: a paper json, None to skip it
+    :param groups: the size groups of the synthetic papers
+    :param json_output: print one json record per paper and stage instead of a table
+    """
+    # Loading nltk is measured by import_time, not here
+    preload()
+    extractor = Extractor(keywords_file, parameters_file)
+    groups = [groups] if isinstance(groups, int) else groups
+    papers = [] if paper is None else [(os.path.basename(paper), get_full_text(paper), None)]
+    papers += [(f'synthetic_group_{group}', synthetic_paper(group), group) for group in groups]
+    if not json_output:
+        print(f'{"paper":<22}{"stage":<20}{"time (s)":>10}{"peak (MB)":>11}{"samples/s":>12}{"entropy":>9}')
+    for name, text, group in papers:
+        for record in bench_paper(extractor, name, text, repeat, expected_group=group):
+            if json_output:
+                print(json.dumps(record))
+            else:
+                samples_per_second = f'{record["samples_per_second"]:.0f}' if 'samples_per_second' in record else ''
+                entropy = f'{record["entropy"]:.3f}' if 'entropy' in record else ''
+                print(f'{name:<22}{record["stage"]:<20}{record["time"]:>10.3f}{record["peak_memory"] / 2 ** 20:>11.1f}'
+                      f'{samples_per_second:>12}{entropy:>9}')
+
+
+if __name__ == '__main__':
+    # python benchmark.py import_time --repeat 5
+    # python benchmark.py run --json_output > bench.jsonl
+    fire.Fire()
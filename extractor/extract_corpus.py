@@ -0,0 +1,87 @@
+# %% Extract a whole corpus of paper jsons into a jsonl file, resumable after a crash or preemption
+import json
+import os
+
+import fire
+
+from extractor import Extractor
+from extractor_utils import get_paper_id, iter_paper_files
+from paper_store import PaperStore, is_paper_store
+from telemetry import JsonlSink
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def read_checkpoint(checkpoint_file):
+    """ The checkpoint has one line per completed paper: its id and the size of the output file after it.
+        Return the completed ids, the output size at the last checkpoint and the size of the complete
+        checkpoint lines. """
+    done = set()
+    offset = 0
+    checkpoint_size = 0
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # half written by a crash
+                    break
+                paper_id, size = line[:-1].decode('utf8').rsplit('\t', 1)
+                done.add(paper_id)
+                offset = int(size)
+                checkpoint_size += len(line)
+    return done, offset, checkpoint_size
+
+
+def main(source, output_file, checkpoint_file=None, errors_file=None, workers=1,
+         keywords_file=os.path.join(HERE, 'keywords.txt'),
+         parameters_file=os.path.join(HERE, 'parameters.txt'),
+         sentence_cache=None, telemetry_file=None):
+    """
+    Extract every paper json (science-parse format) into a jsonl file, one {"id", "extracted"} line per paper.
+    Papers are streamed, so the memory does not depend on the size of the corpus.
+    Run the same command again to resume: papers in the checkpoint are skipped.
+    A paper that fails (e.g. a missing file in the manifest) gets an {"id", "error"} line in the errors file
+    and is not checkpointed, so a rerun tries it again; the errors file keeps the failures of every run.
+    :param source: a directory of paper jsons, a manifest file listing their paths or a store file (see paper_store)
+    :param output_file: the output jsonl file
+    :param checkpoint_file: the completed paper ids, output_file + '.checkpoint' by default
+    :param errors_file: the failed papers, output_file + '.errors' by default
+    :param workers: the number of worker processes
+    :param sentence_cache: optional path of an on-disk sentence cache shared by the workers
+    :param telemetry_file: optional jsonl file of the telemetry (stage timings, CE convergence) of every paper
+    """
+    checkpoint_file = checkpoint_file or output_file + '.checkpoint'
+    errors_file = errors_file or output_file + '.errors'
+    done, offset, checkpoint_size = read_checkpoint(checkpoint_file)
+    telemetry_sink = JsonlSink(telemetry_file) if telemetry_file is not None else None
+    extractor = Extractor(keywords_file, parameters_file, sentence_cache=sentence_cache, telemetry_sink=telemetry_sink)
+
+    if os.path.isfile(source) and is_paper_store(source):
+        store = PaperStore(source)
+        papers = ((paper_id, store.get_full_text(paper_id)) for paper_id in store if paper_id not in done)
+    else:
+        papers = (path for path in iter_paper_files(source) if get_paper_id(path) not in done)
+    num_extracted, num_failed = 0, 0
+    with open(output_file, 'ab') as output, open(checkpoint_file, 'a', encoding='utf8') as checkpoint, \
+            open(errors_file, 'a', encoding='utf8') as errors:
+        # Drop anything written after the last checkpoint, e.g. a half written line
+        output.truncate(offset)
+        checkpoint.truncate(checkpoint_size)
+        for paper, extracted in extractor.iter_extract_many(papers, workers=workers):
+            paper_id = paper[0] if isinstance(paper, tuple) else get_paper_id(paper)
+            if isinstance(extracted, Exception):
+                errors.write(json.dumps({'id': paper_id, 'error': repr(extracted)}) + '\n')
+                errors.flush()
+                num_failed += 1
+                continue
+            output.write((json.dumps({'id': paper_id, 'extracted': extracted}) + '\n').encode('utf8'))
+            output.flush()
+            checkpoint.write(f'{paper_id}\t{output.tell()}\n')
+            checkpoint.flush()
+            num_extracted += 1
+    print(f'{num_extracted} papers extracted, {num_failed} failed, {len(done)} skipped from the checkpoint')
+
+
+if __name__ == '__main__':
+    # python extract_corpus.py dataset/paper_jsons extracted.jsonl --workers 8
+    fire.Fire(main)
@@ -0,0 +1,205 @@
+# %% Local asynchronous extraction service: submit paper jsons, poll or wait for their extraction
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, Optional
+from urllib.parse import parse_qs, urlparse
+
+import fire
+
+from extractor import Extractor, _extract_paper, _init_worker
+from extractor_utils import get_full_text, preload
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class QueueFull(Exception):
+    """ Raised by submit when max_pending jobs are already waiting or running """
+
+
+@dataclass
+class Job:
+    """
+    An extraction job.
+
+    Args:
+        id: the hash of the paper json, the same paper always gets the same job.
+        future: the extraction running in the worker pool.
+    """
+
+    id: str
+    future: object
+
+    @property
+    def status(self) -> str:
+        if not self.future.done():
+            return 'running' if self.future.running() else 'pending'
+        # A future cancelled by close has no exception, future.exception() would raise CancelledError
+        if self.future.cancelled() or self.future.exception() is not None:
+            return 'failed'
+        return 'done'
+
+    def to_dict(self) -> dict:
+        record = {'id': self.id, 'status': self.status}
+        if record['status'] == 'done':
+            record['extracted'] = self.future.result()
+        elif record['status'] == 'failed':
+            record['error'] = 'cancelled' if self.future.cancelled() else repr(self.future.exception())
+        return record
+
+
+class ExtractionService:
+    """
+    Extractions run in the background by a pool of worker processes (threads if workers is 0).
+    Submitting a paper returns a job id at once; submitting the same paper json again gives the same job,
+    unless it failed. At most max_pending jobs wait or run at the same time, and the max_finished
+    latest finished jobs are kept (use a result cache in the extractor to keep all the results).
+    """
+
+    def __init__(self, extractor: Extractor, workers=2, max_pending=64, max_finished=10000):
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        if workers > 0:
+            # Load nltk resources once here, forked workers inherit them
+            preload()
+            self.executor = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(extractor,))
+        else:
+            self.executor = ThreadPoolExecutor(1, initializer=_init_worker, initargs=(extractor,))
+
+    @staticmethod
+    def job_id(paper_json: dict) -> str:
+        return hashlib.sha256(json.dumps(paper_json, sort_keys=True).encode('utf8')).hexdigest()
+
+    def submit(self, paper_json: dict) -> str:
+        """ paper_json: the loaded content of a paper json (science-parse format), return the job id """
+        job_id = self.job_id(paper_json)
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job.status != 'failed':
+                return job_id
+            if sum(not job.future.done() for job in self.jobs.values()) >= self.max_pending:
+                raise QueueFull(f'{self.max_pending} jobs are pending')
+            # The job id seeds the random generator of the extraction (see Extractor.extract_paper)
+            future = self.executor.submit(_extract_paper, (job_id, get_full_text(paper_json)))
+            self.jobs[job_id] = Job(job_id, future)
+            self.jobs.move_to_end(job_id)
+            self.forget_finished()
+        return job_id
+
+    def forget_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.future.done()]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id) -> Optional[Job]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def poll(self, job_id) -> Optional[dict]:
+        """ the status (pending, running, done or failed) of a job, with its result when finished """
+        job = self.get(job_id)
+        return None if job is None else job.to_dict()
+
+    def wait(self, job_id, timeout=None) -> Optional[dict]:
+        """ poll, after waiting at most timeout seconds for the job to finish """
+        job = self.get(job_id)
+        if job is None:
+            return None
+        wait([job.future], timeout=timeout)
+        return job.to_dict()
+
+    def as_completed(self, job_ids, timeout=None) -> Iterator[dict]:
+        """ yield the poll record of every job as it finishes, for at most timeout seconds """
+        pending = {}
+        for job_id in job_ids:
+            job = self.get(job_id)
+            if job is not None:
+                pending[job.future] = job
+        while len(pending) > 0:
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if len(done) == 0:
+                return
+            for future in done:
+                yield pending.pop(future).to_dict()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def make_handler(service: ExtractionService):
+    class Handler(BaseHTTPRequestHandler):
+        """
+        POST /jobs with a paper json body: {"id"} (202), 503 when the queue is full
+        GET /jobs/<id>: {"id", "status", "extracted" or "error"}, 404 for an unknown job
+        GET /jobs/<id>?wait=<seconds>: the same, after waiting for the job to finish, 400 for a wait that is not a number
+        """
+
+        def send_json(self, code, record):
+            body = json.dumps(record).encode('utf8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if urlparse(self.path).path.rstrip('/') != '/jobs':
+                return self.send_json(404, {'error': 'not found'})
+            try:
+                paper_json = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                self.send_json(202, {'id': service.submit(paper_json)})
+            except QueueFull as e:
+                self.send_json(503, {'error': str(e)})
+            except (ValueError, AttributeError, TypeError) as e:
+                self.send_json(400, {'error': f'not a paper json: {e!r}'})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = url.path.strip('/').split('/')
+            if len(parts) != 2 or parts[0] != 'jobs':
+                return self.send_json(404, {'error': 'not found'})
+            timeout = parse_qs(url.query).get('wait')
+            try:
+                timeout = float(timeout[0]) if timeout else None
+            except ValueError:
+                return self.send_json(400, {'error': f'wait is not a number of seconds: {timeout[0]!r}'})
+            record = service.poll(parts[1]) if timeout is None else service.wait(parts[1], timeout)
+            if record is None:
+                return self.send_json(404, {'error': 'unknown job'})
+            self.send_json(200, record)
+
+    return Handler
+
+
+def serve(host='127.0.0.1', port=8000, workers=2, max_pending=64,
+          keywords_file=os.path.join(HERE, 'keywords.txt'),
+          parameters_file=os.path.join(HERE, 'parameters.txt'),
+          result_cache=None):
+    """
+    Run the extraction service over HTTP (see make_handler for the endpoints).
+    :param workers: the number of worker processes
+    :param max_pending: the number of jobs waiting or running at most
+    :param result_cache: optional directory of a result cache, so that results survive a restart
+    """
+    extractor = Extractor(keywords_file, parameters_file, result_cache=result_cache)
+    service = ExtractionService(extractor, workers=workers, max_pending=max_pending)
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    print(f'serving on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    # python extract_service.py --port 8000 --workers 4
+    # curl -X POST --data @paper.json localhost:8000/jobs; curl 'localhost:8000/jobs/<id>?wait=60'
+    fire.Fire(serve)
@@ -1,21 +1,260 @@
 # %%
+import hashlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+
 from extractor_utils import *
+from result_cache import ResultCache
 
 
 class Extractor:
-    def __init__(self, keywords_file, parameters_file):
+    def __init__(self, keywords_file, parameters_file, sentence_cache=None, adaptive_sampling=False,
+                 result_cache=None, result_cache_bytes=2 ** 30, strategy='ce', telemetry_sink=None,
+                 sampler='rejection', chains=1):
+        """ sentence_cache: optional path of an on-disk SentenceCache shared between runs and workers
+            adaptive_sampling: draw fewer CE samples as the CE converges (see AdaptiveSampleSize)
+            strategy: how sentences are selected, 'ce' (CEmethod) or 'local_search' (deterministic and much faster)
+            result_cache: optional directory of a ResultCache of extraction results, holding at most
+            result_cache_bytes
+            sampler: how the CE draws samples of at most 30 sentences, 'rejection' (the original) or 'conditional'
+            (no sample is rejected, see draw_conditional_samples)
+            chains: the number of CE runs batched together, the best one is kept (see multi_chain_CEmethod)
+            telemetry_sink: optional callable receiving the Telemetry of every extract (e.g. list.append or a JsonlSink),
+                with workers > 1 extract_many calls it in the worker processes: use a JsonlSink, a list stays empty
+        """
         self.keywords = read_keywords(keywords_file)
         self.parameters = read_parameters(parameters_file)
+        self.sentence_cache = SentenceCache(sentence_cache) if sentence_cache is not None else None
+        self.adaptive_sampling = adaptive_sampling
+        assert strategy in ['ce', 'local_search'], f'unknown strategy {strategy}'
+        self.strategy = strategy
+        assert sampler in ['rejection', 'conditional'], f'unknown sampler {sampler}'
+        self.sampler = sampler
+        self.chains = chains
+        self.result_cache = ResultCache(result_cache, result_cache_bytes) if result_cache is not None else None
+        self.telemetry_sink = telemetry_sink
 
-    def extract(self, text):
-        np.random.seed(666)
-        filtered_sents, cleaned_filtered_sents = keywords_filtering(text, self.keywords)
-        if len(filtered_sents) <= 30:
-            out_p = np.array([1] * len(filtered_sents))
-        else:
-            group = len(filtered_sents) // 10
-            init_p, init_n = self.parameters[group]
-            out_p = CEmethod(cleaned_filtered_sents, N=init_n, init_p=init_p)
-        samples = [np.random.binomial(1, p=out_p) for j in range(1)]
+        # Everything but the text that a result depends on
+        with open(keywords_file, 'r', encoding='utf8') as f, open(parameters_file, 'r', encoding='utf8') as g:
+            self.fingerprint = ResultCache.key(EXTRACTOR_VERSION, f.read(), g.read(),
+                                               f'adaptive_sampling={adaptive_sampling}', f'strategy={strategy}',
+                                               f'sampler={sampler}', f'chains={chains}')
+
+    def extract(self, text, rng=None, paper_id=None, telemetry: Telemetry = None, previous: dict = None):
+        """ rng: a np.random.Generator. If not given, it is seeded from paper_id (see get_rng),
+            or without paper_id the global RNG is reset to the fixed seed.
+            With a result cache, the result of an unchanged text is not computed again (unless rng is given).
+            telemetry: optional Telemetry filled in with the stage timings, the CE convergence and the memory,
+            one is created for the telemetry sink if there is one.
+            previous: a result of a previous version of the paper to warm start from (see extract_incremental) """
+        if telemetry is None and self.telemetry_sink is not None:
+            telemetry = Telemetry()
+        if telemetry is None:
+            return self._extract(text, rng, paper_id, None, previous)
+        telemetry.paper_id = paper_id
+        with telemetry.memory():
+            extracted = self._extract(text, rng, paper_id, telemetry, previous)
+        if self.telemetry_sink is not None:
+            self.telemetry_sink(telemetry)
+        return extracted
+
+    def _extract(self, text, rng, paper_id, telemetry, previous):
+        key = None
+        # A warm started result differs from the cold one, it is only kept as the latest result of the paper
+        if self.result_cache is not None and rng is None and previous is None:
+            with timed(telemetry, 'result_cache'):
+                key = ResultCache.key(self.fingerprint, paper_id or '', text)
+                record = self.result_cache.get(key)
+            if record is not None:
+                if telemetry is not None:
+                    telemetry.cached = True
+                return record['extracted']
+        if rng is None and paper_id is not None:
+            rng = get_rng(paper_id)
+        elif rng is None:
+            np.random.seed(666)
+            rng = np.random
+
+        filtered_sents, cleaned_filtered_sents = keywords_filtering(text, self.keywords, cache=self.sentence_cache,
+                                                                    telemetry=telemetry)
+        warm_p = None
+        if previous is not None and len(filtered_sents) > 30:
+            prior = self.parameters[len(filtered_sents) // 10][0]
+            warm_p = warm_start_p(previous['sents'], previous['p'], filtered_sents, prior)
+        with timed(telemetry, 'optimize'):
+            out_p = self.optimize(cleaned_filtered_sents, rng, telemetry, warm_p)
+        extracted = get_text(rng.binomial(1, p=out_p), filtered_sents)
+        if self.result_cache is not None and (key is not None or paper_id is not None):
+            record = {'sents': filtered_sents, 'p': out_p.tolist(), 'extracted': extracted}
+            with timed(telemetry, 'result_cache'):
+                if key is not None:
+                    self.result_cache.put(key, record)
+                if paper_id is not None:
+                    self.result_cache.put(self.latest_key(paper_id), record)
+        return extracted
+
+    def latest_key(self, paper_id):
+        """ the result cache key of the latest result of a paper, whatever its text """
+        return ResultCache.key(self.fingerprint, 'latest', paper_id)
+
+    def extract_incremental(self, text, paper_id, previous: dict = None, rng=None, telemetry: Telemetry = None):
+        """ Re-extract a revised version of a paper (e.g. camera-ready) warm started from a previous result:
+            the CE starts from the converged probabilities of the unchanged sentences and from the prior
+            of the parameters table for the new ones, and its first iteration draws fewer samples.
+            previous is a result record {'sents', 'p', ...}, by default the latest result of paper_id
+            in the result cache. Without a previous result, it is extract. """
+        if previous is None and self.result_cache is not None:
+            previous = self.result_cache.get(self.latest_key(paper_id))
+        return self.extract(text, rng, paper_id, telemetry, previous)
+
+    def optimize(self, cleaned_filtered_sents, rng=np.random, telemetry: Telemetry = None,
+                 warm_p: np.array = None) -> np.array:
+        """ Run the sentence-level CE (or local search) over (at most 250) filtered sentences,
+            return the probability vector. warm_p: initial probabilities of a warm start (see warm_start_p) """
+        if len(cleaned_filtered_sents) <= 30:
+            return np.array([1] * len(cleaned_filtered_sents))
+        if self.strategy == 'local_search':
+            return local_search(cleaned_filtered_sents)
+        group = len(cleaned_filtered_sents) // 10
+        init_p, init_n, rho, alpha = self.parameters[group]
+        if warm_p is not None:
+            # A warm start is already close to convergence, like the later iterations
+            init_p, init_n = warm_p, min(init_n, SampleSize().rest)
+        sample_size = AdaptiveSampleSize(init_n, rho) if self.adaptive_sampling else SampleSize(init_n)
+        return CEmethod(cleaned_filtered_sents, N=init_n, init_p=init_p, rho=rho, alpha=alpha, rng=rng,
+                        sample_size=sample_size, telemetry=telemetry, sampler=self.sampler,
+                        chains=self.chains)
+
+    def select(self, filtered_sents, cleaned_filtered_sents, rng=np.random):
+        """ Run the sentence-level CE over (at most 250) filtered sentences, return the extracted text """
+        out_p = self.optimize(cleaned_filtered_sents, rng)
+        samples = [rng.binomial(1, p=out_p) for j in range(1)]
         extracted = get_text(samples[0], filtered_sents)
         return extracted
+
+    def extract_hierarchical(self, sections, block_size=25, max_sents=250, rng=None):
+        """ Extraction for long documents (theses, journal papers) without the 250 sentence cap.
+            sections is a text string or a list of (heading, text) as returned by get_sections.
+            The filtered sentences of every section are cut into blocks of at most block_size sentences,
+            a block-level CE chooses blocks holding at most max_sents sentences,
+            then the sentence-level CE runs inside the chosen blocks. """
+        if rng is None:
+            np.random.seed(666)
+            rng = np.random
+        if isinstance(sections, str):
+            sections = [(None, sections)]
+        blocks = []
+        for _, text in sections:
+            filtered_sents, cleaned_filtered_sents = keywords_filtering(text, self.keywords, max_sents=None,
+                                                                          cache=self.sentence_cache)
+            for start in range(0, len(filtered_sents), block_size):
+                blocks.append((filtered_sents[start: start + block_size],
+                               cleaned_filtered_sents[start: start + block_size]))
+
+        weights = np.array([len(block[0]) for block in blocks])
+        if weights.sum() <= max_sents:
+            chosen = range(len(blocks))
+        else:
+            block_p = CEmethod([" ".join(block[1]) for block in blocks], N=1000,
+                               init_p=max_sents / (2 * weights.sum()), max_selected=max_sents, weights=weights,
+                               rng=rng)
+            # Take the most probable blocks that fit into max_sents, keep the document order
+            chosen, budget = [], max_sents
+            for idx in np.argsort(-block_p, kind='stable'):
+                if weights[idx] <= budget:
+                    chosen.append(idx)
+                    budget -= weights[idx]
+            chosen = sorted(chosen)
+
+        filtered_sents, cleaned_filtered_sents = [], []
+        for idx in chosen:
+            filtered_sents += blocks[idx][0]
+            cleaned_filtered_sents += blocks[idx][1]
+        return self.select(filtered_sents, cleaned_filtered_sents, rng)
+
+    def extract_section_based(self, sections, keep=KEPT_SECTIONS):
+        """ Section-based extraction: the full text of the sections whose heading contains one of keep
+            (the introduction and the conclusion by default). sections is a list of (heading, text)
+            as returned by get_sections. """
+        kept, _ = split_sections(sections, keep)
+        return " ".join(kept)
+
+    def extract_hybrid(self, sections, keep=KEPT_SECTIONS, rng=None):
+        """ Hybrid extraction: the kept sections (see extract_section_based), followed by the sentences
+            the CE selects among the keyword sentences of the other sections only.
+            The CE runs over a much smaller pool than in extract. """
+        if rng is None:
+            np.random.seed(666)
+            rng = np.random
+        kept, rest = split_sections(sections, keep)
+        filtered_sents, cleaned_filtered_sents = keywords_filtering(" ".join(rest), self.keywords,
+                                                                      cache=self.sentence_cache)
+        extracted = self.select(filtered_sents, cleaned_filtered_sents, rng)
+        return " ".join(kept + [extracted]).strip()
+
+    def extract_paper(self, paper):
+        """ Extract a paper json file (its path) or a (paper id, text) pair with its own random generator.
+            The generator is seeded from the paper id (the file name of a paper json),
+            or from the text itself if the paper id is None,
+            so the result does not depend on which process runs it or on what ran before.
+            A missing paper json raises FileNotFoundError, a string is never taken as a text. """
+        if isinstance(paper, tuple):
+            paper_id, text = paper
+            if paper_id is None:
+                paper_id = hashlib.sha256(text.encode('utf8')).hexdigest()
+        else:
+            paper_id = get_paper_id(paper)
+            text = get_full_text(paper)
+        return self.extract(text, paper_id=paper_id)
+
+    def extract_many(self, papers, workers=1):
+        """ Extract many papers (see extract_paper) with a pool of worker processes.
+            The output is in input order and is the same for any number of workers. """
+        papers = list(papers)
+        if workers <= 1:
+            return [self.extract_paper(paper) for paper in papers]
+        chunksize = max(1, len(papers) // (4 * workers))
+        # Load nltk resources once here, forked workers inherit them
+        preload()
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(self,)) as executor:
+            return list(executor.map(_extract_paper, papers, chunksize=chunksize))
+
+    def iter_extract_many(self, papers, workers=1, window=None):
+        """ Lazily extract many papers (see extract_paper), yield (paper, extracted)
+            in completion order. At most window (default 4 * workers) papers are read ahead,
+            so memory does not grow with the number of inputs.
+            If a paper fails, its exception is yielded instead of the extracted text. """
+        if workers <= 1:
+            for paper in papers:
+                try:
+                    yield paper, self.extract_paper(paper)
+                except Exception as e:
+                    yield paper, e
+            return
+
+        papers = iter(papers)
+        window = window or 4 * workers
+        preload()
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(self,)) as executor:
+            pending = {executor.submit(_extract_paper, paper): paper
+                       for paper in islice(papers, window)}
+            while len(pending) > 0:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    error = future.exception()
+                    yield pending.pop(future), future.result() if error is None else error
+                for paper in islice(papers, len(done)):
+                    pending[executor.submit(_extract_paper, paper)] = paper
+
+
+# Every worker process unpickles the extractor once
+_worker_extractor = None
+
+
+def _init_worker(extractor):
+    global _worker_extractor
+    _worker_extractor = extractor
+
+
+def _extract_paper(paper):
+    return _worker_extractor.extract_paper(paper)
@@ -1,43 +1,100 @@
 # %%
+import difflib
+import functools
+import hashlib
 import json
+import os
+import sqlite3
 import sys
 from collections import Counter
-from typing import List
+from dataclasses import dataclass
+from itertools import islice
+from typing import Iterator, List, Set, Tuple
 
-import nltk
 import numpy as np
 import traceback
-from nltk.corpus import stopwords
-from nltk.stem import PorterStemmer
+
+from telemetry import Telemetry, timed
 
 sys.setrecursionlimit(1000000)
-nltk.download('stopwords')
-nltk.download('punkt')
-stemming = PorterStemmer()
-stops = set(stopwords.words("english"))
+
+# Change it whenever a change alters the extraction results, so that cached results are not reused
+EXTRACTOR_VERSION = '1.1'
+
+
+# nltk and its resources are loaded on first use (or by preload), not at import time
+@functools.lru_cache()
+def get_nltk():
+    """ import nltk, download the resources we need only if they are not found locally """
+    import nltk
+    if hasattr(nltk.tokenize, 'PunktTokenizer'):
+        # nltk >= 3.8.2 ships punkt_tab instead of the pickles
+        punkt = ('punkt_tab', 'tokenizers/punkt_tab/english/')
+    else:
+        punkt = ('punkt', 'tokenizers/punkt/english.pickle')
+    for name, path in [('stopwords', 'corpora/stopwords'), punkt]:
+        try:
+            nltk.data.find(path)
+        except LookupError:
+            if not nltk.download(name, quiet=True):
+                raise LookupError(f'nltk resource {name} is not installed and cannot be downloaded, '
+                                  f'install it with nltk.download("{name}") on a machine with network access')
+    return nltk
+
+
+@functools.lru_cache()
+def get_stemmer():
+    from nltk.stem import PorterStemmer
+    return PorterStemmer()
+
+
+@functools.lru_cache()
+def get_stopwords() -> frozenset:
+    return frozenset(get_nltk().corpus.stopwords.words("english"))
+
+
+def word_tokenize(text: str) -> List[str]:
+    return get_nltk().word_tokenize(text)
+
+
+def preload():
+    """ Load nltk and every resource, e.g. once in a parent process before forking workers """
+    get_stemmer()
+    get_stopwords()
+    get_sent_tokenizer()
+    word_tokenize("Warm up the word tokenizer.")
 
 
 # first read keywords table
-def read_keywords(keywords_file):
-    keywords = []
+def read_keywords(keywords_file) -> Set[str]:
+    """ keywords are kept in a set, so that checking a word is a hash lookup """
+    keywords = set()
     with open(keywords_file, 'r', encoding='utf8') as f:
         for line in f.readlines():
             line = line.strip()
-            keywords += line.split(" ")
+            keywords.update(line.split(" "))
     return keywords
 
 
 # then read parameters table
-def read_parameters(parameters_file):
+def read_parameters(parameters_file) -> List[Tuple[float, int, float, float]]:
+    """ one line per group: group init_p init_n, optionally followed by rho alpha (0.05 0.7 by default) """
     parameters = []
     with open(parameters_file, 'r', encoding='utf8') as f:
         for line in f.readlines():
             line = line.strip()
-            _, init_p, init_n = line.split(' ')
-            parameters.append((float(init_p), int(init_n)))
+            _, init_p, init_n, *rest = line.split(' ')
+            rho, alpha = rest if len(rest) > 0 else (0.05, 0.7)
+            parameters.append((float(init_p), int(init_n), float(rho), float(alpha)))
     return parameters
 
 
+def get_rng(paper_id: str) -> np.random.Generator:
+    """ A random generator seeded from a stable hash of the paper id, independent of any other paper """
+    seed = int.from_bytes(hashlib.sha256(paper_id.encode('utf8')).digest()[:8], 'little')
+    return np.random.default_rng(seed)
+
+
 def apply_cleaning_function_to_list(X):
     cleaned_X = []
     for element in X:
@@ -57,48 +114,158 @@ def clean_text(raw_text):
     # Convert to lower case
     text = raw_text.lower()
     # Tokenize
-    tokens = nltk.word_tokenize(text)
+    tokens = word_tokenize(text)
+    # Rejoin meaningful stemmed words
+    joined_words = (" ".join(clean_tokens(tokens)))
+    # Return cleaned data
+    return joined_words
+
+
+def clean_tokens(tokens: List[str]) -> List[str]:
+    """ steps 3) to 5) of clean_text on lower cased tokens """
     # Keep only words (removes punctuation + numbers)
     # use .isalnum to keep also numbers
     token_words = [w for w in tokens if w.isalpha()]
     # Stemming
-    stemmed_words = [stemming.stem(w) for w in token_words]
+    stemmed_words = [stem(w) for w in token_words]
     # Remove stop words
+    stops = get_stopwords()
     meaningful_words = [w for w in stemmed_words if not w in stops]
-    # Rejoin meaningful stemmed words
-    joined_words = (" ".join(meaningful_words))
-    # Return cleaned data
-    return joined_words
+    return meaningful_words
+
+
+@functools.lru_cache(maxsize=2 ** 16)
+def stem(word: str) -> str:
+    """ memoized stemming, the vocabulary of a corpus is small and heavily repeated """
+    return get_stemmer().stem(word)
+
+
+class SentenceCache:
+    """ On-disk (sqlite) cache from sentence hash to its word tokens and meaningful stemmed tokens.
+        It can be shared between runs and between worker processes, every process opens its own connection. """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        return {'path': self.path, '_conn': None, '_pid': None}
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS sents (hash BLOB PRIMARY KEY, words TEXT, tokens TEXT)')
+            self._pid = os.getpid()
+        return self._conn
+
+    @staticmethod
+    def key(sent: str) -> bytes:
+        return hashlib.sha1(sent.encode('utf8')).digest()
+
+    def get_many(self, sents: List[str]) -> dict:
+        """ return {sentence: (words, tokens)} for the cached sentences """
+        keys = {self.key(sent): sent for sent in sents}
+        found = {}
+        key_list = list(keys)
+        for start in range(0, len(key_list), 500):
+            chunk = key_list[start: start + 500]
+            query = 'SELECT hash, words, tokens FROM sents WHERE hash IN (%s)' % ','.join('?' * len(chunk))
+            for key, words, tokens in self.conn.execute(query, chunk):
+                found[keys[key]] = (words.split(' ') if words else [], tokens.split(' ') if tokens else [])
+        return found
+
+    def put_many(self, items: dict):
+        """ items: {sentence: (words, tokens)} """
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO sents VALUES (?, ?, ?)',
+                                  [(self.key(sent), ' '.join(words), ' '.join(tokens))
+                                   for sent, (words, tokens) in items.items()])
+
+
+def get_sections(paper_json) -> List[Tuple[str, str]]:
+    """ give a paper json (its path or its loaded content), return the (heading, text) of each section
+        before the acknowledgement / appendix """
+    sections = []
+    if isinstance(paper_json, dict):
+        content_dict = paper_json
+    else:
+        with open(paper_json, 'r', encoding='utf8') as f:
+            content_dict = json.loads(f.read())
+    for section in content_dict.get('metadata').get('sections'):
+        heading: str = section.get('heading')
+        text: str = section.get('text')
+        if heading is not None:
+            if heading.upper().__contains__('ACKNOW') or heading.upper().__contains__('APPEN'):
+                break
+        if text is not None and len(text) > 0:
+            sections.append((heading, text))
+    return sections
+
+
+def iter_paper_files(source) -> Iterator[str]:
+    """ Lazily list the paper json files of a directory, or of a manifest file (one path per line) """
+    if os.path.isdir(source):
+        for entry in os.scandir(source):
+            if entry.is_file() and entry.name.endswith('.json'):
+                yield entry.path
+    else:
+        with open(source, 'r', encoding='utf8') as f:
+            for line in f:
+                line = line.strip()
+                if len(line) > 0:
+                    yield line
+
+
+def get_paper_id(paper_json) -> str:
+    """ the id of a paper json file is its file name without extension """
+    return os.path.splitext(os.path.basename(paper_json))[0]
 
 
 def get_full_text(paper_json):
     full_text = ""
-    with open(paper_json, 'r', encoding='utf8') as f:
-        content_dict = json.loads(f.read())
-        sections = content_dict.get('metadata').get('sections')
-        for section in sections:
-            heading: str = section.get('heading')
-            text: str = section.get('text')
-            if heading is not None:
-                if heading.upper().__contains__('ACKNOW') or heading.upper().__contains__('APPEN'):
-                    break
-            if text is not None and len(text) > 0:
-                full_text += text + " "
+    for _, text in get_sections(paper_json):
+        full_text += text + " "
     full_text = full_text.replace("\n", " ").encode("utf-8", "ignore").decode("utf-8").strip()
     return full_text
 
 
-# look how the filtering works
-def get_sents(text: str) -> (List, List):
-    """ give a text string, return the sentence list """
+# Sections kept as a whole by the section-based and hybrid extractions
+KEPT_SECTIONS = ('introduction', 'conclusion')
+
+
+def split_sections(sections: List[Tuple[str, str]], keep=KEPT_SECTIONS) -> (List[str], List[str]):
+    """ give (heading, text) sections, return the texts of the sections whose heading contains one of keep
+        (case insensitive) and the texts of the other sections, newlines removed as in get_full_text """
+    kept, rest = [], []
+    for heading, text in sections:
+        text = text.replace("\n", " ").strip()
+        if heading is not None and any(name in heading.lower() for name in keep):
+            kept.append(text)
+        else:
+            rest.append(text)
+    return kept, rest
+
+
+@functools.lru_cache()
+def get_sent_tokenizer():
+    """ the punkt tokenizer behind nltk.tokenize.sent_tokenize """
+    nltk = get_nltk()
+    if hasattr(nltk.tokenize, 'PunktTokenizer'):
+        return nltk.tokenize.PunktTokenizer('english')
+    return nltk.data.load('tokenizers/punkt/english.pickle')
+
+
+def iter_sents(text: str) -> Iterator[str]:
+    """ give a text string, lazily generate the sentences """
     # Here are some heuristics that we use to get appropriate sentence splitter.
     # 1. Delete sentences that are fewer than 25 characters.
     # 2. If a sentence ends in et al. Then concate with the sentence behind it.
-    sent_list: List[str] = nltk.tokenize.sent_tokenize(text)
-    new_sent_list = [sent.replace("\n", "") for sent in sent_list]
-    postprocessed = []
     buff = ""
-    for sent in new_sent_list:
+    for start, end in get_sent_tokenizer().span_tokenize(text):
+        sent = text[start: end].replace("\n", "")
         if sent.endswith('et al.') or sent.endswith('Eq.') \
                 or sent.endswith('i.e.') or sent.endswith('e.g.'):
             buff += sent
@@ -106,25 +273,73 @@ def get_sents(text: str) -> (List, List):
             if len(buff + sent) > 25 and \
                     not (buff + sent).__contains__('arxiv') and \
                     not (buff + sent).__contains__('http'):
-                postprocessed.append(buff + sent)
+                yield buff + sent
             buff = ""
     if len(buff) > 0:
-        postprocessed.append(buff)
-    cleaned_sent_list = apply_cleaning_function_to_list(postprocessed[:250])
-    return postprocessed[:250], cleaned_sent_list
+        yield buff
+
+
+@dataclass
+class Sentence:
+    """
+    A preprocessed sentence.
+
+    Args:
+        text: the raw sentence.
+        tokens: the meaningful stemmed words (see clean_text).
+        has_keyword: whether one of its words is a keyword.
+    """
+
+    text: str
+    tokens: List[str]
+    has_keyword: bool
+
+    @property
+    def cleaned(self) -> str:
+        return " ".join(self.tokens)
+
+
+def preprocess(text: str, keywords: Set[str], max_sents=250, cache: SentenceCache = None,
+               telemetry: Telemetry = None) -> List[Sentence]:
+    """ Split the text into (at most max_sents, None for no limit) sentences.
+        Segmentation stops at the limit, and every sentence is word tokenized only once
+        for both the keyword check and the cleaning (or not at all if it is in the cache). """
+    with timed(telemetry, 'sentence_splitting'):
+        raw_sents = list(islice(iter_sents(text), max_sents))
+    with timed(telemetry, 'cleaning'):
+        cached = cache.get_many(raw_sents) if cache is not None else {}
+        new_items = {}
+        processed = []
+        for sent in raw_sents:
+            if sent in cached:
+                words, tokens = cached[sent]
+            else:
+                words = word_tokenize(sent)
+                tokens = clean_tokens([word.lower() for word in words])
+                new_items[sent] = (words, tokens)
+            processed.append((sent, words, tokens))
+        if cache is not None and len(new_items) > 0:
+            cache.put_many(new_items)
+    with timed(telemetry, 'keywords_filtering'):
+        return [Sentence(sent, tokens, any(word in keywords for word in words)) for sent, words, tokens in processed]
+
+
+# look how the filtering works
+def get_sents(text: str, max_sents=250) -> (List, List):
+    """ give a text string, return the sentence list (at most max_sents sentences, None for no limit) """
+    postprocessed = list(islice(iter_sents(text), max_sents))
+    cleaned_sent_list = apply_cleaning_function_to_list(postprocessed)
+    return postprocessed, cleaned_sent_list
 
 
-def keywords_filtering(text: str, keywords: List[str]) -> (List[str], List[str]):
-    sents, cleaned_sents = get_sents(text)
+def keywords_filtering(text: str, keywords: Set[str], max_sents=250, cache: SentenceCache = None,
+                       telemetry: Telemetry = None) -> (List[str], List[str]):
     filtered_sents = []
     cleaned_filtered_sents = []
-    for sent, clean_sent in zip(sents, cleaned_sents):
-        words = nltk.word_tokenize(sent)
-        for word in words:
-            if word in keywords:
-                filtered_sents.append(sent)
-                cleaned_filtered_sents.append(clean_sent)
-                break
+    for sent in preprocess(text, keywords, max_sents, cache, telemetry):
+        if sent.has_keyword:
+            filtered_sents.append(sent.text)
+            cleaned_filtered_sents.append(sent.cleaned)
     return filtered_sents, cleaned_filtered_sents
 
 
@@ -143,7 +358,7 @@ def get_text(sample: np.array, sent_list: List[str]) -> str:
 
 
 def get_score(text: str) -> float:
-    words = nltk.word_tokenize(text)
+    words = word_tokenize(text)
     summ_len = len(words)
     counter = Counter(words)
     v = np.array(list(counter.values())) / summ_len
@@ -158,43 +373,378 @@ def isAllZeroOrOne(array):
     return True
 
 
-def CEmethod(sent_list: List[str], N=10000, init_p=0.5, rho=0.05, alpha=0.7, iter=100) -> np.array:
+def get_count_matrix(sent_list: List[str]) -> np.array:
+    """ Tokenize every sentence once, return a (sentence x vocabulary) count matrix """
+    vocab = {}
+    rows, cols = [], []
+    for idx, sent in enumerate(sent_list):
+        for word in word_tokenize(sent):
+            rows.append(idx)
+            cols.append(vocab.setdefault(word, len(vocab)))
+    counts = np.zeros((len(sent_list), len(vocab)))
+    np.add.at(counts, (rows, cols), 1)
+    return counts
+
+
+def get_scores(samples: np.array, counts: np.array, chunk_size=1024, max_elements=2 ** 19) -> np.array:
+    """ Vectorized version of score, gives the entropy of every sample (one sample per row).
+        Samples are scored chunk_size at a time, fewer for a large vocabulary so that the
+        (samples x vocabulary) temporaries hold at most max_elements floats. """
+    chunk_size = max(1, min(chunk_size, max_elements // max(1, counts.shape[1])))
+    scores = np.zeros(len(samples))
+    for start in range(0, len(samples), chunk_size):
+        # Word counts of each sampled text are a single matrix product
+        v = samples[start: start + chunk_size] @ counts
+        summ_len = v.sum(axis=1, keepdims=True)
+        np.divide(v, summ_len, out=v, where=summ_len > 0)
+        log_v = np.log2(v, out=np.zeros_like(v), where=v > 0)
+        log_v *= v
+        scores[start: start + chunk_size] = -log_v.sum(axis=1)
+    return scores
+
+
+def packed_mean(packed: np.array, length: int) -> np.array:
+    """ Mean of bit-packed samples (np.packbits along the rows) without unpacking them,
+        return the frequency of each of the length units """
+    ones = np.zeros(packed.shape[1] * 8)
+    for bit in range(8):
+        # packbits puts the first unit of every byte in its highest bit
+        ones[bit::8] = ((packed >> (7 - bit)) & 1).sum(axis=0)
+    return ones[:length] / len(packed)
+
+
+def draw_samples(p: np.array, N: int, counts: np.array, max_selected=30, weights=None,
+                 rng=np.random, chunk_size=1024) -> (np.array, np.array):
+    """ Draw N samples, chunk_size at a time, return the ones selecting at most max_selected sentences,
+        bit-packed along the rows (one bit per sentence), with their scores.
+        If weights is given, a unit i counts as weights[i] sentences.
+        The random stream is the same as drawing the N samples at once. """
+    packed, scores = [], []
+    for start in range(0, N, chunk_size):
+        samples = rng.binomial(1, p=p, size=(min(chunk_size, N - start), len(p)))
+        selected = samples.sum(axis=1) if weights is None else samples @ weights
+        samples = samples[selected <= max_selected]
+        packed.append(np.packbits(samples.astype(np.uint8), axis=1))
+        scores.append(get_scores(samples, counts))
+    return np.concatenate(packed), np.concatenate(scores)
+
+
+def draw_conditional_samples(p: np.array, N: int, counts: np.array, max_selected=30, weights=None,
+                             rng=np.random, chunk_size=1024) -> (np.array, np.array):
+    """ Same as draw_samples, but draw the N samples directly from the Bernoulli(p) distribution conditioned on
+        selecting at most max_selected sentences, so that no sample is rejected.
+        z[i, c] is the probability (up to a factor per row) that the units i.. fit into a capacity c,
+        the units are then drawn in order with P(x_i = 1 | remaining capacity c) = p_i z[i + 1, c - w_i] / z[i, c].
+        Weights must be non-negative integers. """
+    weights = np.ones(len(p), dtype=int) if weights is None else np.asarray(weights).astype(int)
+    z = np.zeros((len(p) + 1, max_selected + 1))
+    z[-1] = 1.0
+    for i in range(len(p) - 1, -1, -1):
+        take = np.zeros(max_selected + 1)
+        take[weights[i]:] = z[i + 1, :max_selected + 1 - weights[i]]
+        z[i] = (1 - p[i]) * z[i + 1] + p[i] * take
+        # Rescale every row against underflow, only ratios of consecutive rows are used
+        if z[i].max() > 0:
+            z[i] /= z[i].max()
+    if z[0, max_selected] == 0:
+        raise ValueError(f'no sample selects at most {max_selected} sentences')
+
+    packed, scores = [], []
+    for start in range(0, N, chunk_size):
+        size = min(chunk_size, N - start)
+        uniform = rng.random_sample((size, len(p))) if rng is np.random else rng.random((size, len(p)))
+        samples = np.zeros((size, len(p)), dtype=np.uint8)
+        capacity = np.full(size, max_selected)
+        for i in range(len(p)):
+            left = capacity - weights[i]
+            take = np.where(left >= 0, p[i] * z[i + 1, np.maximum(left, 0)], 0.0)
+            leave = (1 - p[i]) * z[i + 1, capacity]
+            selected = uniform[:, i] * (take + leave) < take
+            samples[:, i] = selected
+            capacity -= selected * weights[i]
+        packed.append(np.packbits(samples, axis=1))
+        scores.append(get_scores(samples, counts))
+    return np.concatenate(packed), np.concatenate(scores)
+
+
+def xlog2x(x: np.array) -> np.array:
+    """ x * log2(x), with 0 for 0 """
+    return x * np.log2(x, out=np.zeros_like(x, dtype=float), where=x > 0)
+
+
+def local_search(sent_list: List[str], max_selected=30, max_passes=10) -> np.array:
+    """ Deterministic alternative to CEmethod for the same objective (the entropy of the selected sentences).
+        Greedily add the best sentence until max_selected, then swap a selected sentence for a better one
+        until no swap improves the entropy (or max_passes passes over the selected sentences).
+        Running word counts c give the entropy as log2(L) - sum(c log2 c) / L with L = sum(c),
+        so applying a move costs O(|sentence|) and all candidate moves are scored in O(total words).
+        Return the selection as a 0/1 probability vector. """
+    counts = get_count_matrix(sent_list)
+    rows, cols = np.nonzero(counts)
+    values = counts[rows, cols]
+    sent_lens = counts.sum(axis=1)
+    entries = np.split(np.arange(len(rows)), np.cumsum(np.bincount(rows, minlength=len(sent_list)))[:-1])
+
+    word_counts = np.zeros(counts.shape[1])
+    state = {'len': 0.0, 'clogc': 0.0}
+
+    def entropy(summ_len, clogc):
+        return np.where(summ_len > 0, np.log2(np.maximum(summ_len, 1)) - clogc / np.maximum(summ_len, 1), 0.0)
+
+    def entropy_after_adding() -> np.array:
+        """ the entropy after adding each sentence to the current selection """
+        delta = xlog2x(word_counts[cols] + values) - xlog2x(word_counts[cols])
+        clogc = state['clogc'] + np.bincount(rows, weights=delta, minlength=len(sent_list))
+        return entropy(state['len'] + sent_lens, clogc)
+
+    def move(idx, sign):
+        """ add (sign=1) or remove (sign=-1) a sentence, O(|sentence|) """
+        words = cols[entries[idx]]
+        old = xlog2x(word_counts[words]).sum()
+        word_counts[words] += sign * values[entries[idx]]
+        state['clogc'] += xlog2x(word_counts[words]).sum() - old
+        state['len'] += sign * sent_lens[idx]
+
+    selected = np.zeros(len(sent_list), dtype=bool)
+    current = 0.0
+    while selected.sum() < min(max_selected, len(sent_list)):
+        scores = np.where(selected, -np.inf, entropy_after_adding())
+        best = int(np.argmax(scores))
+        if selected.any() and scores[best] <= current:
+            break
+        move(best, 1)
+        selected[best] = True
+        current = float(scores[best])
+
+    for _ in range(max_passes):
+        improved = False
+        for idx in np.flatnonzero(selected):
+            move(idx, -1)
+            selected[idx] = False
+            scores = np.where(selected, -np.inf, entropy_after_adding())
+            scores[idx] = -np.inf
+            best = int(np.argmax(scores))
+            if scores[best] > current + 1e-12:
+                idx, current, improved = best, float(scores[best]), True
+            move(idx, 1)
+            selected[idx] = True
+        if not improved:
+            break
+    return selected.astype(float)
+
+
+def warm_start_p(old_sents: List[str], old_p: List[float], new_sents: List[str], prior: float,
+                 smoothing=0.1) -> np.array:
+    """ Initial CE probabilities of new_sents from a previous run over old_sents (a previous version of the paper).
+        The sentences matched by difflib start from their old probability, moved towards the prior by smoothing
+        so that a converged 0 or 1 can still change, the new sentences start from the prior. """
+    p = np.full(len(new_sents), prior, dtype=float)
+    matcher = difflib.SequenceMatcher(None, old_sents, new_sents, autojunk=False)
+    for old_start, new_start, size in matcher.get_matching_blocks():
+        old = np.asarray(old_p[old_start: old_start + size], dtype=float)
+        p[new_start: new_start + size] = (1 - smoothing) * old + smoothing * prior
+    return p
+
+
+class SampleSize:
+    """ Number of samples of every CE iteration: N in the first one, then 1000 (the original schedule).
+        spent counts every drawn sample, including the rejected ones. """
+
+    def __init__(self, N=10000, rest=1000):
+        self.N = N
+        self.rest = rest
+        self.iteration = 0
+        self.spent = 0
+
+    def next(self) -> int:
+        return self.N if self.iteration == 0 else self.rest
+
+    def update(self, p: np.array, gamma: float):
+        """ called at the end of every iteration with the new p and gamma """
+        self.iteration += 1
+
+
+class AdaptiveSampleSize(SampleSize):
+    """ N samples in the first iteration, then as many as needed for the current p.
+        The elite mean estimates every p_i from rho * n samples with variance p_i * (1 - p_i) / (rho * n),
+        so n keeps its standard error under tol: it drops as p moves to 0 or 1.
+        While gamma still changes by more than gamma_tol (relative), n does not drop. """
+
+    def __init__(self, N=10000, rho=0.05, tol=0.1, gamma_tol=0.01, min_n=100, max_n=10000):
+        super().__init__(N)
+        self.rho = rho
+        self.tol = tol
+        self.gamma_tol = gamma_tol
+        self.min_n = min_n
+        self.max_n = max_n
+        self.n = min(N, max_n)
+        self.gamma = None
+
+    def next(self) -> int:
+        return self.N if self.iteration == 0 else self.n
+
+    def update(self, p: np.array, gamma: float):
+        n = int(np.ceil(np.max(p * (1 - p)) / (self.rho * self.tol ** 2)))
+        if self.gamma is not None and abs(gamma - self.gamma) > self.gamma_tol * abs(gamma):
+            n = max(n, self.n)
+        self.n = int(np.clip(n, self.min_n, self.max_n))
+        self.gamma = gamma
+        self.iteration += 1
+
+
+def elite_mean(samples: np.array, scores: np.array, rho: float, length: int) -> (float, np.array):
+    """ give bit-packed samples and their scores, return gamma (the 1 - rho quantile of the scores)
+        and the mean of the samples scoring at least gamma """
+    # np.quantile does not require a sorted input
+    gamma = np.quantile(scores, 1 - rho)
+
+    valid_samples = samples[scores >= gamma]
+
+    # Relax the gamma a little bit due to floating point precision issue
+    closeness = 0.0000000000001
+    while len(valid_samples) == 0:
+        valid_samples = samples[scores >= gamma - closeness]
+        closeness *= 10
+
+    return gamma, packed_mean(valid_samples, length)
+
+
+def draw_chain_samples(p: np.array, N: int, counts: np.array, max_selected=30, weights=None,
+                       rng=np.random, sampler='rejection', chunk_size=1024) -> (np.array, np.array, np.array):
+    """ Draw N samples for every row (chain) of p, return the valid ones bit-packed (see draw_samples),
+        their scores and the row they were drawn for. The rejection sampler draws and scores all chains together. """
+    if sampler == 'conditional':
+        draws = [draw_conditional_samples(chain_p, N, counts, max_selected, weights, rng, chunk_size) for chain_p in p]
+        chains = np.concatenate([np.full(len(scores), k) for k, (_, scores) in enumerate(draws)])
+        return np.concatenate([samples for samples, _ in draws]), np.concatenate([scores for _, scores in draws]), chains
+
+    rows = np.repeat(np.arange(len(p)), N)
+    packed, scores, chains = [], [], []
+    for start in range(0, len(rows), chunk_size):
+        chunk_rows = rows[start: start + chunk_size]
+        # Comparing uniforms is much faster than a binomial draw per element
+        uniform = rng.random_sample(p[chunk_rows].shape) if rng is np.random else rng.random(p[chunk_rows].shape)
+        samples = (uniform < p[chunk_rows]).astype(np.uint8)
+        selected = samples.sum(axis=1) if weights is None else samples @ weights
+        valid = selected <= max_selected
+        samples = samples[valid]
+        packed.append(np.packbits(samples, axis=1))
+        scores.append(get_scores(samples, counts))
+        chains.append(chunk_rows[valid])
+    return np.concatenate(packed), np.concatenate(scores), np.concatenate(chains)
+
+
+def multi_chain_CEmethod(counts: np.array, p: np.array, rho: float, alpha: float, iter: int, max_selected: int,
+                         weights, rng, sample_size: SampleSize, telemetry: Telemetry, sampler: str) -> np.array:
+    """ The CE iterations of chains (rows of p) run together, every chain has its own elite and early stop.
+        Return the p of the chain with the highest final gamma. """
+    chains = len(p)
+    active = np.ones(chains, dtype=bool)
+    early_stop_step = np.zeros(chains, dtype=int)
+    gamma_old = np.zeros(chains)
+    gammas = [[] for _ in range(chains)]
+    stop_reasons = ['max_iterations'] * chains
+    for i in range(iter):
+        N = sample_size.next()
+        # Chains without any valid sample draw again, as in CEmethod
+        pending = np.flatnonzero(active)
+        parts = []
+        while len(pending) > 0:
+            samples, scores, drawn_for = draw_chain_samples(p[pending], N, counts, max_selected, weights, rng,
+                                                            sampler)
+            sample_size.spent += N * len(pending)
+            telemetry.samples_drawn += N * len(pending)
+            telemetry.samples_rejected += N * len(pending) - len(samples)
+            parts.append((samples, scores, pending[drawn_for]))
+            pending = np.setdiff1d(pending, pending[drawn_for])
+        samples = np.concatenate([part[0] for part in parts])
+        scores = np.concatenate([part[1] for part in parts])
+        drawn_for = np.concatenate([part[2] for part in parts])
+
+        for k in np.flatnonzero(active):
+            mine = drawn_for == k
+            gamma, new_p = elite_mean(samples[mine], scores[mine], rho, p.shape[1])
+            if gamma == gamma_old[k]:
+                early_stop_step[k] += 1
+            p[k] = alpha * p[k] + (1 - alpha) * new_p
+            gamma_old[k] = gamma
+            gammas[k].append(float(gamma))
+            if early_stop_step[k] >= 3:
+                stop_reasons[k] = 'early_stop'
+                active[k] = False
+            elif isAllZeroOrOne(p[k]):
+                stop_reasons[k] = 'converged'
+                active[k] = False
+        sample_size.update(p[active] if active.any() else p, gamma_old.max())
+        telemetry.iterations += 1
+        if not active.any():
+            break
+
+    best = int(np.argmax(gamma_old))
+    telemetry.gammas = gammas[best]
+    telemetry.stop_reason = stop_reasons[best]
+    return p[best]
+
+
+def CEmethod(sent_list: List[str], N=10000, init_p=0.5, rho=0.05, alpha=0.7, iter=100,
+             max_selected=30, weights=None, rng=np.random, sample_size: SampleSize = None,
+             telemetry: Telemetry = None, sampler='rejection', chains=1) -> np.array:
+    """ rng is np.random (the global RNG) or a np.random.Generator.
+        init_p is the initial probability of every sentence, or an array of one probability per sentence.
+        sample_size gives the number of samples of every iteration, SampleSize(N) by default.
+        If telemetry is given, the iterations, gammas, samples and stop reason are recorded in it.
+        sampler: 'rejection' draws Bernoulli samples and rejects the ones selecting more than max_selected units,
+        'conditional' draws them from the conditioned distribution (see draw_conditional_samples), the samples
+        follow the same distribution but with another random stream.
+        chains: the number of independent CE runs (with their own samples), run together in one batch.
+        The chain with the highest final gamma is returned (see multi_chain_CEmethod). """
+    if sample_size is None:
+        sample_size = SampleSize(N)
+    if telemetry is None:
+        telemetry = Telemetry()
+    telemetry.stop_reason = 'max_iterations'
+    draw = {'rejection': draw_samples, 'conditional': draw_conditional_samples}[sampler]
     try:
-        p = np.array([init_p] * len(sent_list))
+        counts = get_count_matrix(sent_list)
+        p = np.full(len(sent_list), init_p, dtype=float)
+        if chains > 1:
+            return multi_chain_CEmethod(counts, np.tile(p, (chains, 1)), rho, alpha, iter, max_selected, weights,
+                                        rng, sample_size, telemetry, sampler)
         early_stop_step = 0
         gamma_old = 0.0
         for i in range(iter):
-            if i >= 1:
-                N = 1000
-            samples = [np.random.binomial(1, p=p) for j in range(N)]
-            scored_samples = [(sample, score(sample, sent_list)) for sample in samples if sample.sum() <= 30]
-
-            while len(scored_samples) == 0:
-                samples = [np.random.binomial(1, p=p) for j in range(N)]
-                scored_samples = [(sample, score(sample, sent_list)) for sample in samples if sample.sum() <= 30]
-
-            # np.quantile does not require a sorted input
-            gamma = np.quantile([x[1] for x in scored_samples], 1 - rho)
+            N = sample_size.next()
+            samples, scores = draw(p, N, counts, max_selected, weights, rng)
+            sample_size.spent += N
+            telemetry.samples_drawn += N
+            telemetry.samples_rejected += N - len(samples)
 
-            valid_samples = [sample[0] for sample in scored_samples if sample[1] >= gamma]
+            while len(samples) == 0:
+                samples, scores = draw(p, N, counts, max_selected, weights, rng)
+                sample_size.spent += N
+                telemetry.samples_drawn += N
+                telemetry.samples_rejected += N - len(samples)
 
-            # Relax the gamma a little bit due to floating point precision issue
-            closeness = 0.0000000000001
-            while len(valid_samples) == 0:
-                valid_samples = [sample[0] for sample in scored_samples if sample[1] >= gamma - closeness]
-                closeness *= 10
-
-            new_p = sum(valid_samples) / len(valid_samples)
+            gamma, new_p = elite_mean(samples, scores, rho, len(p))
 
             if gamma == gamma_old:
                 early_stop_step += 1
 
             p = alpha * p + (1 - alpha) * new_p
             gamma_old = gamma
+            sample_size.update(p, gamma)
+            telemetry.iterations += 1
+            telemetry.gammas.append(float(gamma))
 
-            if early_stop_step >= 3 or isAllZeroOrOne(p):
+            if early_stop_step >= 3:
+                telemetry.stop_reason = 'early_stop'
+                break
+            if isAllZeroOrOne(p):
+                telemetry.stop_reason = 'converged'
                 break
         return p
 
-    except:
+    except Exception:
+        telemetry.stop_reason = 'error'
+        telemetry.error = traceback.format_exc()
         return np.array([0] * len(sent_list))
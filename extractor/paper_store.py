@@ -0,0 +1,148 @@
+# %% Pack a corpus of paper jsons into one binary file, read a paper body with one slice and no json parsing
+import mmap
+import os
+import struct
+from typing import Iterator, List, Tuple
+
+import fire
+
+from extractor_utils import get_full_text, get_paper_id, get_sections, iter_paper_files
+
+# File layout (little endian):
+#   header: MAGIC, u64 offset of the index, u64 number of papers
+#   for every paper: its body, the utf8 section texts (before the acknowledgement / appendix) joined by a space,
+#                    then its section table: for every section, u64 start and u64 end of the text in the body,
+#                    u32 heading length (NO_HEADING if None) and the utf8 heading
+#   index: for every paper, u32 id length, the utf8 id, u64 body offset, u64 body length,
+#          u64 section table offset, u32 number of sections
+MAGIC = b'RAPAPERS'
+HEADER = struct.Struct('<8sQQ')
+SECTION = struct.Struct('<QQI')
+INDEX_ENTRY = struct.Struct('<QQQI')
+NO_HEADING = 0xFFFFFFFF
+
+
+def is_paper_store(path) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def normalize(text: str) -> str:
+    """ the same normalization as get_full_text """
+    return text.replace("\n", " ").encode("utf-8", "ignore").decode("utf-8")
+
+
+def pack(source, store_file):
+    """
+    Pack paper jsons into a store file.
+    :param source: a directory of paper jsons or a manifest file listing their paths
+    :param store_file: the output store file
+    """
+    index = []
+    with open(store_file, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, 0, 0))
+        for path in iter_paper_files(source):
+            sections = get_sections(path)
+            texts = [normalize(text).encode('utf8') for _, text in sections]
+            body = b' '.join(texts)
+            body_offset = f.tell()
+            f.write(body)
+
+            table_offset = f.tell()
+            start = 0
+            for (heading, _), text in zip(sections, texts):
+                if heading is None:
+                    f.write(SECTION.pack(start, start + len(text), NO_HEADING))
+                else:
+                    heading = heading.encode('utf8')
+                    f.write(SECTION.pack(start, start + len(text), len(heading)) + heading)
+                start += len(text) + 1
+            index.append((get_paper_id(path), body_offset, len(body), table_offset, len(sections)))
+
+        index_offset = f.tell()
+        for paper_id, *entry in index:
+            paper_id = paper_id.encode('utf8')
+            f.write(struct.pack('<I', len(paper_id)) + paper_id + INDEX_ENTRY.pack(*entry))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, index_offset, len(index)))
+    print(f'{len(index)} papers packed into {store_file}')
+
+
+class PaperStore:
+    """ Memory-mapped read access to a store file written by pack """
+
+    def __init__(self, store_file):
+        self.store_file = store_file
+        with open(store_file, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_offset, num_papers = HEADER.unpack_from(self.data, 0)
+        assert magic == MAGIC, f'{store_file} is not a paper store'
+
+        self.index = {}
+        pos = index_offset
+        for _ in range(num_papers):
+            id_len, = struct.unpack_from('<I', self.data, pos)
+            paper_id = self.data[pos + 4: pos + 4 + id_len].decode('utf8')
+            pos += 4 + id_len
+            self.index[paper_id] = INDEX_ENTRY.unpack_from(self.data, pos)
+            pos += INDEX_ENTRY.size
+
+    def __getstate__(self):
+        # worker processes map the file again
+        return {'store_file': self.store_file}
+
+    def __setstate__(self, state):
+        self.__init__(state['store_file'])
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, paper_id):
+        return paper_id in self.index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.index)
+
+    def get_full_text(self, paper_id) -> str:
+        """ same as get_full_text on the paper json """
+        body_offset, body_len, _, _ = self.index[paper_id]
+        return self.data[body_offset: body_offset + body_len].decode('utf8').strip()
+
+    def get_sections(self, paper_id) -> List[Tuple[str, str]]:
+        """ same as get_sections on the paper json, with the normalized section texts """
+        body_offset, _, pos, num_sections = self.index[paper_id]
+        sections = []
+        for _ in range(num_sections):
+            start, end, heading_len = SECTION.unpack_from(self.data, pos)
+            pos += SECTION.size
+            heading = None
+            if heading_len != NO_HEADING:
+                heading = self.data[pos: pos + heading_len].decode('utf8')
+                pos += heading_len
+            sections.append((heading, self.data[body_offset + start: body_offset + end].decode('utf8')))
+        return sections
+
+    def close(self):
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def iter_paper_texts(source) -> Iterator[Tuple[str, str]]:
+    """ Lazily read (paper id, full text) from a store file, a directory of paper jsons or a manifest file """
+    if os.path.isfile(source) and is_paper_store(source):
+        with PaperStore(source) as store:
+            for paper_id in store:
+                yield paper_id, store.get_full_text(paper_id)
+    else:
+        for path in iter_paper_files(source):
+            yield get_paper_id(path), get_full_text(path)
+
+
+if __name__ == '__main__':
+    # python paper_store.py pack dataset/paper_jsons papers.store
+    fire.Fire({'pack': pack})
@@ -0,0 +1,86 @@
+# %% Content-addressed on-disk cache of extraction results
+import hashlib
+import json
+import os
+from typing import Optional
+
+
+class ResultCache:
+    """
+    Extraction results stored as json files named by a hash of everything the result depends on.
+    When the cache grows over max_bytes, the least recently used results are evicted.
+    It can be shared between runs and between worker processes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(size for _, size, _ in self.stat_files())
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        h = hashlib.sha256()
+        for part in parts:
+            h.update(part.encode('utf8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def iter_files(self):
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_dir():
+                for file in os.scandir(entry.path):
+                    if file.name.endswith('.json'):
+                        yield file.path
+
+    def stat_files(self):
+        """ (last use, size, path) of every result """
+        for path in self.iter_files():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # evicted by another process
+                continue
+            yield stat.st_mtime, stat.st_size, path
+
+    def get(self, key: str) -> Optional[dict]:
+        path = self.path(key)
+        try:
+            with open(path, 'r', encoding='utf8') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # The modification time records the last use for the eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return record
+
+    def put(self, key: str, record: dict):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so that readers never see a half written file
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path)
+        self.size += os.path.getsize(path)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """ remove the least recently used results until the cache is under 90% of max_bytes """
+        files = sorted(self.stat_files())
+        self.size = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.size -= size
@@ -0,0 +1,89 @@
+# %% Optional instrumentation of an extraction: stage timings, CE convergence and memory
+import json
+import resource
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+
+@dataclass
+class Telemetry:
+    """
+    Measurements of one extraction, filled in by Extractor.extract and CEmethod when given one.
+
+    Args:
+        trace_memory: measure peak_memory with tracemalloc (slow).
+        paper_id: the paper id given to extract, if any.
+        cached: whether the result came from the result cache.
+        stages: the wall time of every stage in seconds.
+        iterations: the number of CE iterations.
+        gammas: the gamma (elite score threshold) of every CE iteration.
+        samples_drawn: every drawn CE sample, including the rejected ones.
+        samples_rejected: the CE samples selecting too many sentences.
+        stop_reason: why the CE stopped: 'early_stop' (gamma unchanged), 'converged' (p all 0 or 1),
+            'max_iterations' or 'error'.
+        error: the traceback of the CE error, if any.
+        peak_memory: the peak traced memory of the extraction in bytes, None without trace_memory.
+        process_peak_rss: the peak RSS of the process since it started (not of this extraction) in bytes.
+    """
+
+    trace_memory: bool = False
+    paper_id: Optional[str] = None
+    cached: bool = False
+    stages: Dict[str, float] = field(default_factory=dict)
+    iterations: int = 0
+    gammas: List[float] = field(default_factory=list)
+    samples_drawn: int = 0
+    samples_rejected: int = 0
+    stop_reason: Optional[str] = None
+    error: Optional[str] = None
+    peak_memory: Optional[int] = None
+    process_peak_rss: Optional[int] = None
+
+    @contextmanager
+    def stage(self, name):
+        """ add the wall time of the block to the stage """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    @contextmanager
+    def memory(self):
+        """ record the peak traced memory of the block, and the process peak RSS at its end """
+        started = self.trace_memory and not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        elif self.trace_memory:
+            tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            if self.trace_memory:
+                self.peak_memory = tracemalloc.get_traced_memory()[1]
+                if started:
+                    tracemalloc.stop()
+            # ru_maxrss is in kilobytes on linux
+            self.process_peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def timed(telemetry: Optional[Telemetry], name):
+    """ telemetry.stage(name), or nothing without telemetry """
+    return nullcontext() if telemetry is None else telemetry.stage(name)
+
+
+class JsonlSink:
+    """ A telemetry sink appending every record as a json line, it can be shared between worker processes """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, telemetry: Telemetry):
+        with open(self.path, 'a', encoding='utf8') as f:
+            f.write(json.dumps(telemetry.to_dict()) + '\n')
@@ -1,4 +1,8 @@
-from typing import Dict, List
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import fire
+import jsonlines
+import numpy as np
 
 from transformers import (
     AutoConfig,
@@ -9,7 +13,7 @@ from transformers import (
 from helper.annotator_utils import *
 from helper.utils import TokenClassifier, align_predictions
 import nltk
-from helper.heuristics import heuristics
+from helper.heuristics import get_jsonlines, heuristics
 
 import logging
 
@@ -17,7 +21,7 @@ logging.disable(logging.WARNING)
 
 
 class Annotator:
-    def __init__(self, label_file, model_file_path, device):
+    def __init__(self, label_file, model_file_path, device, batch_size=32, max_padding=64, pack=False):
         # get labels
         labels = []
         with open(label_file, 'r', encoding='utf8') as f:
@@ -30,7 +34,7 @@ class Annotator:
         num_labels = len(label_map)
 
         # get tokenizer
-        self.tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path=model_file_path)
+        self.tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path=model_file_path, use_fast=True)
 
         # get model config
         config = AutoConfig.from_pretrained(
@@ -54,7 +58,10 @@ class Annotator:
         self.token_classifier = TokenClassifier(
             tokenizer=self.tokenizer,
             model=self.model,
-            labels=self.labels
+            labels=self.labels,
+            batch_size=batch_size,
+            max_padding=max_padding,
+            pack=pack
         )
 
     def prepare_inputs(self, text: str) -> List[List[str]]:
@@ -62,14 +69,13 @@ class Annotator:
         new_sents = [nltk.word_tokenize(sent) for sent in sents]
         return new_sents
 
-    def annotate(self, text):
-        inputs = self.prepare_inputs(text)
-        preds, label_ids = self.token_classifier.classify_token(inputs)
-        preds_list, _ = align_predictions(preds, label_ids, self.label_map)
+    def label_words(self, inputs: List[List[str]], preds_list: List[List[str]]) -> List[Tuple[str, str]]:
+        """ pair the words of the sentences with their predicted labels """
         assert len(inputs) == len(preds_list)
         output = []
-        for words, labels, label_id in zip(inputs, preds_list, label_ids):
-            assert len(words) == len(labels) or len(label_id) == 512
+        for words, labels in zip(inputs, preds_list):
+            # Fewer labels only for a sentence truncated to max_seq_length wordpieces
+            assert len(words) >= len(labels)
             if len(words) != len(labels):
                 max_len = len(words)
                 while len(labels) < max_len:
@@ -77,5 +83,67 @@ class Annotator:
             assert len(words) == len(labels)
             for word, label in zip(words, labels):
                 output.append((word, label))
+        return output
+
+    def annotate(self, text):
+        inputs = self.prepare_inputs(text)
+        preds, label_ids = self.token_classifier.classify_token(inputs)
+        preds_list, _ = align_predictions(preds, label_ids, self.label_map)
+        output = self.label_words(inputs, preds_list)
         output = heuristics(output)
         return output
+
+    def iter_labeled_words(self, texts: Iterable[str], pool_size=256) -> Iterator[List[Tuple[str, str]]]:
+        """ label_words of every text, the sentences of consecutive texts are classified together
+            until they reach pool_size sentences """
+        pool = []
+        for text in texts:
+            pool.append(self.prepare_inputs(text))
+            if sum(len(inputs) for inputs in pool) >= pool_size:
+                yield from self.label_pool(pool)
+                pool = []
+        if len(pool) > 0:
+            yield from self.label_pool(pool)
+
+    def label_pool(self, pool: List[List[List[str]]]) -> Iterator[List[Tuple[str, str]]]:
+        sents = [sent for inputs in pool for sent in inputs]
+        preds_list = []
+        if len(sents) > 0:
+            # With packing, sentences of different texts do not share a window
+            starts = np.cumsum([0] + [len(inputs) for inputs in pool[:-1]])
+            preds, label_ids = self.token_classifier.classify_token(sents, starts=starts)
+            preds_list, _ = align_predictions(preds, label_ids, self.label_map)
+        start = 0
+        for inputs in pool:
+            yield self.label_words(inputs, preds_list[start: start + len(inputs)])
+            start += len(inputs)
+
+    def annotate_many(self, texts: Iterable[str], pool_size=256) -> Iterator[List[Tuple[str, str]]]:
+        """ Lazily annotate many texts (e.g. a generator of reviews), yield the output of annotate for every text,
+            in order. The sentences of consecutive texts are pooled (up to pool_size sentences) and classified
+            together, so short reviews share batches and memory does not grow with the number of texts. """
+        for output in self.iter_labeled_words(texts, pool_size):
+            # An empty text has no output
+            yield heuristics(output) if len(output) > 0 else []
+
+
+def annotate_file(input_file, output_file, model_file_path='seqlab_final', label_file='labels.txt', device='cpu',
+                  batch_size=32, pool_size=256):
+    """
+    Annotate a file with one review per line (see sample.txt) into a jsonl file with one {"id", "text", "labels"}
+    line per review, the same output as prepare.sh, run_tagger.py and post_process.sh.
+    :param device: 'cpu' or 'gpu'
+    """
+    annotator = Annotator(label_file, model_file_path, device, batch_size=batch_size)
+    with open(input_file, 'r', encoding='utf8') as f, jsonlines.open(output_file, 'w') as writer:
+        texts = (line.strip() for line in f)
+        for review_id, output in enumerate(annotator.iter_labeled_words(texts, pool_size)):
+            if len(output) == 0:
+                writer.write({'id': review_id, 'text': '', 'labels': []})
+            else:
+                writer.write(get_jsonlines([heuristics([review_id] + output)])[0])
+
+
+if __name__ == '__main__':
+    # python annotator.py sample.txt result.jsonl --device gpu
+    fire.Fire(annotate_file)
@@ -1,13 +1,17 @@
 # coding=utf-8
 # Adapted from Huggingface token-classification task
 
+import inspect
 from dataclasses import dataclass
 from typing import List, Optional
 
 import numpy as np
 import torch
 from torch import nn
-from transformers import PreTrainedTokenizer, AutoModelForTokenClassification
+from transformers import BatchEncoding, PreTrainedTokenizer, AutoModelForTokenClassification
+
+# The label id of the positions without a label (special tokens, padding and the wordpieces after the first one)
+PAD_TOKEN_LABEL_ID = nn.CrossEntropyLoss().ignore_index
 
 
 @dataclass
@@ -39,8 +43,10 @@ def convert_examples_to_features(
         pad_token_segment_id=0,
         pad_token_label_id=-100,
         sequence_a_segment_id=0,
+        pad_to_max_length=True,
 ):
     """Loads a data file into a list of `InputFeatures`
+    `pad_to_max_length` pads every feature to max_seq_length, otherwise features keep their length
     `cls_token_at_end` define the location of the CLS token:
         - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
         - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
@@ -104,7 +110,7 @@ def convert_examples_to_features(
         input_mask = [1] * len(input_ids)
 
         # Zero-pad up to the sequence length.
-        padding_length = max_seq_length - len(input_ids)
+        padding_length = max_seq_length - len(input_ids) if pad_to_max_length else 0
 
         # pad on the right
         input_ids += [pad_token] * padding_length
@@ -112,10 +118,8 @@ def convert_examples_to_features(
         segment_ids += [pad_token_segment_id] * padding_length
         label_ids += [pad_token_label_id] * padding_length
 
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-        assert len(label_ids) == max_seq_length
+        assert len(input_ids) == len(input_mask) == len(segment_ids) == len(label_ids)
+        assert len(input_ids) <= max_seq_length
 
         features.append(
             {'input_ids': torch.tensor(input_ids, dtype=torch.long).unsqueeze(0),
@@ -126,20 +130,74 @@ def convert_examples_to_features(
     return features
 
 
-def align_predictions(predictions: np.ndarray, label_ids: np.ndarray, label_map):
-    preds = np.argmax(predictions, axis=2)
+def supports_word_ids(tokenizer: PreTrainedTokenizer) -> bool:
+    """ whether convert_examples_to_features_fast can be used: a fast (Rust) tokenizer """
+    return getattr(tokenizer, 'is_fast', False)
+
+
+def tokenize_words(tokenizer: PreTrainedTokenizer, sents: List[List[str]], **kwargs) -> BatchEncoding:
+    """ one call of the tokenizer on pre-split words: is_pretokenized in transformers 3.0 and 3.1,
+        is_split_into_words since """
+    if 'is_split_into_words' in inspect.signature(tokenizer.__call__).parameters:
+        return tokenizer(sents, is_split_into_words=True, **kwargs)
+    return tokenizer(sents, is_pretokenized=True, **kwargs)
 
-    batch_size, seq_len = preds.shape
 
-    out_label_list = [[] for _ in range(batch_size)]
-    preds_list = [[] for _ in range(batch_size)]
+def word_ids(encodings: BatchEncoding, i: int) -> List[Optional[int]]:
+    """ the word of every token of the i-th sentence, None for the special tokens (words() before transformers 4) """
+    return encodings.word_ids(i) if hasattr(BatchEncoding, 'word_ids') else encodings.words(i)
+
+
+def convert_examples_to_features_fast(
+        examples: List[InputExample],
+        label_list: List[str],
+        max_seq_length: int,
+        tokenizer: PreTrainedTokenizer,
+        pad_token_label_id=-100,
+):
+    """Same features as convert_examples_to_features without padding, from a single call of a fast tokenizer
+    on the words of all the examples. The label of a word goes to its first token (found with word_ids)."""
+    if len(examples) == 0:
+        return []
+    label_map = {label: i for i, label in enumerate(label_list)}
+    encodings = tokenize_words(tokenizer, [example.words for example in examples], truncation=True,
+                               max_length=max_seq_length)
 
-    for i in range(batch_size):
-        for j in range(seq_len):
-            if label_ids[i, j] != nn.CrossEntropyLoss().ignore_index:
-                out_label_list[i].append(label_map[label_ids[i][j]])
-                preds_list[i].append(label_map[preds[i][j]])
+    features = []
+    for i, example in enumerate(examples):
+        label_ids = []
+        previous_word_id = None
+        for word_id in word_ids(encodings, i):
+            if word_id is None or word_id == previous_word_id:
+                label_ids.append(pad_token_label_id)
+            else:
+                label_ids.append(label_map[example.labels[word_id]])
+            previous_word_id = word_id
 
+        input_ids = encodings['input_ids'][i]
+        segment_ids = encodings['token_type_ids'][i] if 'token_type_ids' in encodings else [0] * len(input_ids)
+        features.append(
+            {'input_ids': torch.tensor(input_ids, dtype=torch.long).unsqueeze(0),
+             'attention_mask': torch.tensor(encodings['attention_mask'][i], dtype=torch.long).unsqueeze(0),
+             'token_type_ids': torch.tensor(segment_ids, dtype=torch.long).unsqueeze(0),
+             'labels': torch.tensor(label_ids, dtype=torch.long).unsqueeze(0)}
+        )
+    return features
+
+
+def align_predictions(predictions: np.ndarray, label_ids: np.ndarray, label_map):
+    """ predictions: logits (sentence x length x label) or predicted label ids (sentence x length).
+        Return the predicted and the true labels of every sentence, at the positions with a label id """
+    preds = np.argmax(predictions, axis=2) if predictions.ndim == 3 else predictions
+    if len(preds) == 0:
+        return [], []
+
+    label_names = np.empty(len(label_map), dtype=object)
+    label_names[:] = [label_map[i] for i in range(len(label_map))]
+    mask = label_ids != PAD_TOKEN_LABEL_ID
+    sentence_ends = np.cumsum(mask.sum(axis=1))[:-1]
+    preds_list = [list(labels) for labels in np.split(label_names[preds[mask]], sentence_ends)]
+    out_label_list = [list(labels) for labels in np.split(label_names[label_ids[mask]], sentence_ends)]
     return preds_list, out_label_list
 
 
@@ -149,14 +207,25 @@ class TokenClassifier:
             tokenizer: PreTrainedTokenizer,
             model: AutoModelForTokenClassification,
             labels: List[str],
-            max_seq_length=512
+            max_seq_length=512,
+            batch_size=32,
+            max_padding=64,
+            pack=False
     ):
+        """ Sentences are sorted by length and classified in batches of at most batch_size sentences,
+            padded to the longest one of their batch. A batch is cut before a sentence that would
+            add more than max_padding pad tokens to the shortest sentence of the batch.
+            With pack, consecutive sentences are classified together in windows of max_seq_length wordpieces
+            (see pack_sentences), so that they share their context. """
         self.tokenizer = tokenizer
         self.model = model
         self.model.eval()
         self.labels = labels
         self.max_seq_length = max_seq_length
-        self.pad_token_label_id = nn.CrossEntropyLoss().ignore_index
+        self.batch_size = batch_size
+        self.max_padding = max_padding
+        self.pack = pack
+        self.pad_token_label_id = PAD_TOKEN_LABEL_ID
 
     def prepare_features(self, sents: List[List[str]]):
         input_examples = []
@@ -164,6 +233,14 @@ class TokenClassifier:
             labels = ['O'] * len(sent)
             input_examples.append(InputExample(guid=f'{i}', words=sent, labels=labels))
 
+        if supports_word_ids(self.tokenizer):
+            return convert_examples_to_features_fast(
+                examples=input_examples,
+                label_list=self.labels,
+                max_seq_length=self.max_seq_length,
+                tokenizer=self.tokenizer,
+                pad_token_label_id=self.pad_token_label_id
+            )
         features = convert_examples_to_features(
             examples=input_examples,
             label_list=self.labels,
@@ -174,40 +251,106 @@ class TokenClassifier:
             sep_token=self.tokenizer.sep_token,
             pad_token=self.tokenizer.pad_token_id,
             pad_token_segment_id=self.tokenizer.pad_token_type_id,
-            pad_token_label_id=self.pad_token_label_id
+            pad_token_label_id=self.pad_token_label_id,
+            pad_to_max_length=False
         )
         return features
 
-    def classify_token(self, sents: List[List[str]]):
-        features = self.prepare_features(sents)
-
-        preds: torch.Tensor = None
-        label_ids: torch.Tensor = None
+    def make_batches(self, lengths: List[int]) -> List[List[int]]:
+        """ group the sentence indices by length (see __init__) """
+        batches = []
+        for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+            if len(batches) == 0 or len(batches[-1]) == self.batch_size \
+                    or lengths[i] - lengths[batches[-1][0]] > self.max_padding:
+                batches.append([])
+            batches[-1].append(i)
+        return batches
+
+    def collate(self, features: List[dict]) -> dict:
+        """ pad features (of shape 1 x length) to the longest one, return (batch x length) tensors """
+        padding_values = {
+            'input_ids': self.tokenizer.pad_token_id,
+            'attention_mask': 0,
+            'token_type_ids': self.tokenizer.pad_token_type_id,
+            'labels': self.pad_token_label_id
+        }
+        return {k: nn.utils.rnn.pad_sequence([feature[k][0] for feature in features], batch_first=True,
+                                             padding_value=v)
+                for k, v in padding_values.items()}
+
+    def pack_sentences(self, sents: List[List[str]], starts=()) -> (List[List[int]], List[int]):
+        """ Return windows of consecutive sentence indices holding at most max_seq_length wordpieces
+            (with the special tokens), and the number of wordpieces of every sentence.
+            The sentences whose index is in starts (e.g. the first sentence of every review) begin a new window. """
+        if supports_word_ids(self.tokenizer) and len(sents) > 0:
+            encodings = tokenize_words(self.tokenizer, sents, add_special_tokens=False)
+            lengths = [len(input_ids) for input_ids in encodings['input_ids']]
+        else:
+            lengths = [sum(len(self.tokenizer.tokenize(word)) for word in sent) for sent in sents]
+        capacity = self.max_seq_length - self.tokenizer.num_special_tokens_to_add()
+        windows = []
+        used = 0
+        for i, length in enumerate(lengths):
+            if len(windows) == 0 or used + length > capacity or i in starts:
+                windows.append([])
+                used = 0
+            windows[-1].append(i)
+            used += length
+        return windows, lengths
+
+    def classify_token(self, sents: List[List[str]], starts=()):
+        """ Return the predicted label ids and the label ids (both sentence x length) of the sentences,
+            in their order, padded to the longest sentence (with pad_token_label_id for the label ids).
+            Predictions are only set where the label id is not pad_token_label_id.
+            starts: with pack, the sentences beginning a new window (see pack_sentences) """
+        if not self.pack:
+            return self.classify_sequences(sents)
+
+        windows, lengths = self.pack_sentences(sents, set(starts))
+        window_preds, window_label_ids = self.classify_sequences(
+            [[word for i in window for word in sents[i]] for window in windows])
+        if window_preds is None:
+            return None, None
+
+        # Split the windows back into sentences, each one between a [CLS] and a [SEP] position
+        max_len = min(max(lengths), window_preds.shape[1] - 2) + 2
+        preds = np.zeros((len(sents), max_len), dtype=window_preds.dtype)
+        label_ids = np.full((len(sents), max_len), self.pad_token_label_id, dtype=np.int64)
+        for w, window in enumerate(windows):
+            start = 1
+            for i in window:
+                # A sentence longer than a window is truncated, as without packing
+                length = min(lengths[i], window_preds.shape[1] - 1 - start)
+                preds[i, 1: 1 + length] = window_preds[w, start: start + length]
+                label_ids[i, 1: 1 + length] = window_label_ids[w, start: start + length]
+                start += length
+        return preds, label_ids
 
-        for inputs in features:
-            for k, v in inputs.items():
-                if isinstance(v, torch.Tensor):
-                    inputs[k] = v.to(self.model.device)
+    def classify_sequences(self, sents: List[List[str]]):
+        """ classify_token without packing """
+        features = self.prepare_features(sents)
+        if len(features) == 0:
+            return None, None
+        lengths = [feature['input_ids'].shape[1] for feature in features]
+
+        # Only the predicted label ids of the labeled positions leave the device, in the smallest int type
+        dtype = np.int8 if len(self.labels) <= np.iinfo(np.int8).max else np.int16
+        preds = np.zeros((len(features), max(lengths)), dtype=dtype)
+        label_ids = np.full((len(features), max(lengths)), self.pad_token_label_id, dtype=np.int64)
+        for batch in self.make_batches(lengths):
+            inputs = self.collate([features[i] for i in batch])
+            labels = inputs.pop('labels')
+            mask = labels != self.pad_token_label_id
+            inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
 
             with torch.no_grad():
-                outputs = self.model(**inputs)
-                step_eval_loss, logits = outputs[:2]
-
-            # output predictions
-            if preds is None:
-                preds = logits.detach()
-            else:
-                preds = torch.cat((preds, logits.detach()), dim=0)
-
-            if inputs.get('labels') is not None:
-                if label_ids is None:
-                    label_ids = inputs['labels'].detach()
-                else:
-                    label_ids = torch.cat((label_ids, inputs['labels'].detach()))
-
-        # Finally, turn the aggregated tensors into numpy arrays.
-        if preds is not None:
-            preds = preds.cpu().numpy()
-        if label_ids is not None:
-            label_ids = label_ids.cpu().numpy()
+                logits = self.model(**inputs)[0]
+                batch_preds = logits.argmax(dim=-1)[mask.to(logits.device)].to(getattr(torch, dtype.__name__))
+
+            # Put the sentences back in their order
+            batch_len = labels.shape[1]
+            sub_preds = np.zeros((len(batch), batch_len), dtype=dtype)
+            sub_preds[mask.numpy()] = batch_preds.cpu().numpy()
+            preds[batch, :batch_len] = sub_preds
+            label_ids[batch, :batch_len] = labels.numpy()
         return preds, label_ids
@@ -23,7 +23,6 @@ from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 from seqeval.metrics import accuracy_score, f1_score, precision_score, recall_score
-from torch import nn
 
 from transformers import (
     AutoConfig,
@@ -35,6 +34,7 @@ from transformers import (
     TrainingArguments,
     set_seed,
 )
+from helper.utils import align_predictions as align_label_ids
 from helper.utils_batch import Split, TokenClassificationDataset, TokenClassificationTask
 
 
@@ -205,20 +205,7 @@ def main():
     )
 
     def align_predictions(predictions: np.ndarray, label_ids: np.ndarray) -> Tuple[List[int], List[int]]:
-        preds = np.argmax(predictions, axis=2)
-
-        batch_size, seq_len = preds.shape
-
-        out_label_list = [[] for _ in range(batch_size)]
-        preds_list = [[] for _ in range(batch_size)]
-
-        for i in range(batch_size):
-            for j in range(seq_len):
-                if label_ids[i, j] != nn.CrossEntropyLoss().ignore_index:
-                    out_label_list[i].append(label_map[label_ids[i][j]])
-                    preds_list[i].append(label_map[preds[i][j]])
-
-        return preds_list, out_label_list
+        return align_label_ids(predictions, label_ids, label_map)
 
     def compute_metrics(p: EvalPrediction) -> Dict:
         preds_list, out_label_list = align_predictions(p.predictions, p.label_ids)